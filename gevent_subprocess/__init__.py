@@ -23,3 +23,4 @@
 # SOFTWARE.
 
 from .gevent_subprocess import *
+from .supervisor import Supervisor, SupervisedPopen
@@ -29,12 +29,271 @@ from subprocess import \
 # a way to access original subprocess
 import subprocess as _subprocess
 
+__all__ = [
+    'CalledProcessError', 'PIPE', 'STDOUT', 'PTY', 'MEMFD',
+    'TimeoutExpired', 'ESCALATION',
+    'READ_BUDGET', 'READ_TIME_BUDGET',
+    'PRIORITY_LOW', 'PRIORITY_NORMAL', 'PRIORITY_HIGH',
+    'PipeStats', 'CompressedOutput', 'Pipe', 'PtyPipe', 'TeeConsumer',
+    'process_table', 'Popen', 'call', 'check_call', 'check_output',
+    'Command',
+]
+
 import os
+import sys
+import inspect
 import fcntl
+import mmap
 import errno
+import pty
+import termios
+import json
+import signal
+import struct
+import tempfile
+import time
+import weakref
+import zlib
+from collections import namedtuple
 import gevent
+from gevent.event import Event
+from gevent.queue import Queue, Full
 from gevent.socket import wait_read, wait_write
 
+try:
+    import ctypes
+    _libc = ctypes.CDLL(None, use_errno=True)
+    _syscall = _libc.syscall
+    _syscall.restype = ctypes.c_long
+except (ImportError, OSError, AttributeError):
+    _libc = None
+    _syscall = None
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+
+def _monotonic_clock():
+    if hasattr(time, 'monotonic'):
+        return time.monotonic
+    if _libc is None or not hasattr(_libc, 'clock_gettime'):
+        return time.time
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    ts = timespec()
+    clock_gettime = _libc.clock_gettime
+    CLOCK_MONOTONIC = 1
+
+    def monotonic():
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+    return monotonic
+
+_monotonic = _monotonic_clock()
+
+
+class TimeoutExpired(Exception):
+    """This exception is raised when the timeout expires while waiting for
+    a child process.
+    """
+    def __init__(self, cmd, timeout, output=None):
+        Exception.__init__(self, cmd, timeout)
+        self.cmd = cmd
+        self.timeout = timeout
+        self.output = output
+
+    def __str__(self):
+        if self.cmd is None:
+            return "Timed out after %s seconds" % (self.timeout,)
+        return "Command '%s' timed out after %s seconds" % \
+            (self.cmd, self.timeout)
+
+
+# Like PIPE, but the child gets the slave side of a pseudo-terminal, so
+# that it keeps its interactive (line) buffering. For stdout and stderr.
+PTY = -3
+
+
+# For stdin and stdout: the child gets a memory file (memfd) instead of a
+# pipe. stdin is filled with memfd_input and sealed before the child starts,
+# stdout is mapped in the parent after the child exits. Linux only.
+MEMFD = -4
+
+
+# What to do with a child whose deadline expired: send each signal in turn,
+# and give it the grace period (in seconds) to exit before the next one.
+# A grace of None means waiting for as long as it takes.
+ESCALATION = ((signal.SIGTERM, 5.0), (signal.SIGKILL, None))
+
+
+class _Deadline(object):
+    __slots__ = ('wheel', 'rounds', 'callback', 'args', 'slot', 'expired')
+
+    def __init__(self, wheel, rounds, callback, args):
+        self.wheel = wheel
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+        self.slot = None
+        self.expired = False
+
+    @property
+    def cancelled(self):
+        return self.slot is None and not self.expired
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+            self.wheel._pending -= 1
+
+
+class _DeadlineWheel(object):
+    """A hashed timer wheel shared by every child.
+
+    Scheduling and cancelling a deadline are O(1), and a single greenlet
+    ticks the wheel (only while there is something to tick), so tens of
+    thousands of pending deadlines cost one timer in the hub instead of one
+    each.
+
+    Ticks are numbered from the time the ticker started, on a monotonic
+    clock. Tick n goes to slot n % size, and is processed no sooner than
+    n * resolution seconds after the start; when the hub was late, every
+    tick due by now is processed on wakeup, so delays do not add up.
+    """
+
+    def __init__(self, resolution=0.05, size=512):
+        self._resolution = resolution
+        self._slots = [set() for x in xrange(size)]
+        self._origin = 0
+        self._ticks = 0
+        self._pending = 0
+        self._ticker = None
+
+    def _due(self, now):
+        return int((now - self._origin) / self._resolution)
+
+    def schedule(self, seconds, callback=None, *args):
+        now = _monotonic()
+        if self._ticker is None:
+            self._origin = now
+            self._ticks = 0
+        # now is somewhere within the current tick, one extra tick makes
+        # sure that a deadline never expires early.
+        target = self._due(now) + 1 + \
+            max(0, int(-(-seconds // self._resolution)))
+        rounds = (target - self._ticks - 1) // len(self._slots)
+        deadline = _Deadline(self, rounds, callback, args)
+        deadline.slot = self._slots[target % len(self._slots)]
+        deadline.slot.add(deadline)
+        self._pending += 1
+        if self._ticker is None:
+            self._ticker = gevent.spawn(self._run)
+        return deadline
+
+    def _run(self):
+        try:
+            while self._pending > 0:
+                due = self._due(_monotonic())
+                while self._ticks < due and self._pending > 0:
+                    self._ticks += 1
+                    self._tick(self._slots[self._ticks % len(self._slots)])
+                if self._pending > 0:
+                    next_tick = self._origin + \
+                        (self._ticks + 1) * self._resolution
+                    gevent.sleep(max(0, next_tick - _monotonic()))
+        finally:
+            self._ticker = None
+
+    def _tick(self, slot):
+        expired = []
+        for deadline in slot:
+            if deadline.rounds > 0:
+                deadline.rounds -= 1
+            else:
+                expired.append(deadline)
+        for deadline in expired:
+            slot.discard(deadline)
+            deadline.slot = None
+            deadline.expired = True
+            self._pending -= 1
+        for deadline in expired:
+            if deadline.callback is not None:
+                deadline.callback(*deadline.args)
+
+
+_deadlines = _DeadlineWheel()
+
+
+def _interrupt(glet, exception, armed):
+    # throwing from the hub, like gevent.Timeout does, but only if the
+    # greenlet is still waiting for the deadline by then.
+    def _throw():
+        if armed[0]:
+            glet.throw(exception)
+    gevent.get_hub().loop.run_callback(_throw)
+
+
+# How much a pipe can read (bytes, seconds spent reading) before it yields to
+# the hub, so that one fast producer cannot starve every other pipe. The byte
+# budget is scaled by the priority of the pipe.
+READ_BUDGET = 256 * 1024
+READ_TIME_BUDGET = 0.005
+
+PRIORITY_LOW = 0.25
+PRIORITY_NORMAL = 1
+PRIORITY_HIGH = 4
+
+
+class PipeStats(object):
+    """I/O counters of a Pipe.
+
+    bytes and reads count what went through the pipe, waits how many times
+    it had to wait for the fd to be ready, and yields how many times it gave
+    the hub away after using up its read budget. sched_delay and
+    max_sched_delay sum up, and keep the worst of, the time it then spent
+    queued before running again.
+    """
+
+    __slots__ = ('bytes', 'reads', 'waits', 'yields', 'sched_delay',
+                 'max_sched_delay')
+
+    def __init__(self):
+        self.bytes = 0
+        self.reads = 0
+        self.waits = 0
+        self.yields = 0
+        self.sched_delay = 0.0
+        self.max_sched_delay = 0.0
+
+
+# A capture compressed on the fly: data is the compressed string (or the
+# file object it was written to), size is the original size.
+CompressedOutput = namedtuple('CompressedOutput', 'data size')
+
+
+def _compressor(method):
+    if method == 'zlib':
+        return zlib.compressobj()
+    if method == 'gzip':
+        return zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED,
+                                16 + zlib.MAX_WBITS)
+    if method == 'lzma':
+        if lzma is None:
+            raise ValueError("lzma compression requires the lzma module "
+                             "(backports.lzma on Python 2)")
+        return lzma.LZMACompressor()
+    raise ValueError("unknown compression method: %r" % (method,))
+
 
 class Pipe(object):
 
@@ -42,6 +301,10 @@ class Pipe(object):
         self._fd = fd
         self._closed = False
         self._readline_buffer = ''
+        self.priority = PRIORITY_NORMAL
+        self.stats = PipeStats()
+        self._budget_used = 0
+        self._budget_time = 0
 
         # we want the non-blocking behaviour
         flags = fcntl.fcntl(self._fd, fcntl.F_GETFL)
@@ -67,40 +330,78 @@ class Pipe(object):
             try:
                 bytes_written = os.write(self._fd, data)
                 data = data[bytes_written:]
+                self.stats.bytes += bytes_written
             except OSError as e:
                 if e.errno == errno.EPIPE:
                     self.close()
                     raise IOError(e)
                 if e.errno != errno.EAGAIN:
                     raise
+                self.stats.waits += 1
                 wait_write(self._fd)
 
     def writelines(self, sequence):
         for line in sequence:
             self.write(line)
 
+    def _reset_budget(self):
+        self._budget_used = 0
+        self._budget_time = 0
+
+    def _yield(self):
+        start = time.time()
+        gevent.sleep(0)
+        delay = time.time() - start
+        self.stats.yields += 1
+        self.stats.sched_delay += delay
+        self.stats.max_sched_delay = max(self.stats.max_sched_delay, delay)
+        self._reset_budget()
+
+    def _recv(self, size=64 * 1024):
+        if self._budget_used >= READ_BUDGET * self.priority or \
+                self._budget_time >= READ_TIME_BUDGET:
+            self._yield()
+        # only the time spent in here counts, not what the caller does with
+        # the data in between reads.
+        start = time.time()
+        try:
+            while True:
+                try:
+                    buffer = os.read(self._fd, size)
+                except OSError as e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                    self.stats.waits += 1
+                    wait_read(self._fd)
+                    # waiting for data already gave the hub away.
+                    self._reset_budget()
+                    start = time.time()
+                    continue
+                if len(buffer) == 0:
+                    self.close()
+                self.stats.reads += 1
+                self.stats.bytes += len(buffer)
+                self._budget_used += len(buffer)
+                return buffer
+        finally:
+            self._budget_time += time.time() - start
+
     def _read(self, size=-1, greedy=True):
         data = ''
         while size != 0:
-            try:
-                buffer = os.read(self._fd, size if size > 0 else 64 * 1024)
-                bytes_read = len(buffer)
-                if bytes_read == 0:
-                    self.close()
-                    break
-                if size > 0:
-                    size -= bytes_read
-                data += buffer
-                if size < 0 and not greedy:
-                    break
-            except OSError as e:
-                if e.errno != errno.EAGAIN:
-                    raise
-                wait_read(self._fd)
+            buffer = self._recv(size if size > 0 else 64 * 1024)
+            bytes_read = len(buffer)
+            if bytes_read == 0:
+                break
+            if size > 0:
+                size -= bytes_read
+            data += buffer
+            if size < 0 and not greedy:
+                break
         return data
 
     def read(self, size=-1, greedy=True):
-        data = self._read(size, greedy)
+        data = self._read(size, greedy) if not self.closed else ''
         if len(self._readline_buffer) != 0:
             data = self._readline_buffer + data
             self._readline_buffer = ''
@@ -138,16 +439,526 @@ class Pipe(object):
     def next(self):
         return self.readline()
 
+    def read_compressed(self, method='zlib', fileobj=None):
+        """Read until EOF, compressing every chunk as soon as it is received,
+        and return a CompressedOutput.
+
+        method is one of 'zlib', 'gzip' or 'lzma'. The compressed stream is
+        written to fileobj if given, otherwise returned as a string. Either
+        way, the raw data is never held in memory as a whole.
+        """
+        compressor = _compressor(method)
+        chunks = []
+        write = chunks.append if fileobj is None else fileobj.write
+        data = self._readline_buffer
+        self._readline_buffer = ''
+        size = 0
+        while True:
+            if len(data) != 0:
+                size += len(data)
+                write(compressor.compress(data))
+            if self.closed:
+                break
+            data = self._recv()
+        write(compressor.flush())
+        if fileobj is None:
+            return CompressedOutput(''.join(chunks), size)
+        return CompressedOutput(fileobj, size)
+
+    def tee(self, n=2, maxsize=64, policy='block'):
+        """Deliver every chunk read from the pipe to n consumers, and return
+        the list of TeeConsumer.
+
+        The same (immutable) string is handed to every consumer, each one
+        with its own queue of at most maxsize chunks. policy tells what to
+        do when a queue is full: 'block' the reading (and so the child),
+        'drop' the chunk for that consumer, or 'spill' it to a temporary
+        file to be delivered later. policy can also be a list with one
+        policy per consumer.
+        """
+        if isinstance(policy, basestring):
+            policy = [policy] * n
+        if len(policy) != n:
+            raise ValueError("%d policies given for %d consumers"
+                             % (len(policy), n))
+        consumers = [TeeConsumer(maxsize, p) for p in policy]
+
+        def _pump():
+            chunk = self._readline_buffer
+            self._readline_buffer = ''
+            error = None
+            try:
+                while True:
+                    if len(chunk) != 0:
+                        for consumer in consumers:
+                            consumer._put(chunk)
+                    if self.closed:
+                        break
+                    chunk = self._recv()
+            except Exception as e:
+                # the consumers get the error in place of a truncated EOF.
+                error = e
+            finally:
+                for consumer in consumers:
+                    consumer._put_eof(error)
+        gevent.spawn(_pump)
+        return consumers
+
+    def expect(self, patterns, timeout=None, window=1024):
+        """Read until one of patterns is found, and return (index, match,
+        before): the index of the pattern that matched first, the match
+        (a match object for a regex, the string itself for a literal) and
+        the data before it. What follows the match stays buffered.
+
+        patterns is a pattern or a list of patterns, each one a compiled
+        regex or a literal string. Only the newly received data, plus a
+        carry-over of window bytes for regexes (len(literal) - 1 for
+        literals), is scanned on every read, so regex matches must not be
+        longer than window. Another window bytes before that are kept as
+        context for lookbehinds and anchors: '^' and '\\A' only match at the
+        start of what was buffered when expect was called. Raise
+        TimeoutExpired after timeout seconds, or EOFError at EOF, the data
+        read so far staying buffered.
+        """
+        if not isinstance(patterns, (list, tuple)):
+            patterns = [patterns]
+        carries = [len(p) - 1 if isinstance(p, basestring) else window
+                   for p in patterns]
+
+        armed = [True]
+        deadline = None
+        if timeout is not None:
+            deadline = _deadlines.schedule(timeout, _interrupt,
+                                           gevent.getcurrent(),
+                                           TimeoutExpired(None, timeout),
+                                           armed)
+        # data already scanned is parked in chunks, and only the tail (the
+        # largest carry-over, some context before it, plus what was just
+        # received) is scanned and grown, so every read costs its own size
+        # rather than the total. Thanks to the context, a trimmed tail is
+        # never searched from its index 0, which the regex engine would take
+        # for the start of the data.
+        chunks = []
+        tail, self._readline_buffer = self._readline_buffer, ''
+        keep = (max(carries) if carries else 0) + max(1, window)
+        done = False
+        try:
+            scanned = 0
+            while True:
+                best = None
+                for index, pattern in enumerate(patterns):
+                    start = max(0, scanned - carries[index])
+                    if isinstance(pattern, basestring):
+                        begin = tail.find(pattern, start)
+                        if begin == -1:
+                            continue
+                        end, match = begin + len(pattern), pattern
+                    else:
+                        match = pattern.search(tail, start)
+                        if match is None:
+                            continue
+                        begin, end = match.span()
+                    if best is None or begin < best[0]:
+                        best = (begin, end, index, match)
+                if best is not None:
+                    begin, end, index, match = best
+                    chunks.append(tail[:begin])
+                    self._readline_buffer = tail[end:]
+                    done = True
+                    return index, match, ''.join(chunks)
+                if self.closed:
+                    raise EOFError("EOF while expecting %r" % (patterns,))
+                if len(tail) > keep:
+                    chunks.append(tail[:len(tail) - keep])
+                    tail = tail[len(tail) - keep:]
+                scanned = len(tail)
+                tail += self._recv()
+        finally:
+            if not done:
+                chunks.append(tail)
+                self._readline_buffer = ''.join(chunks)
+            armed[0] = False
+            if deadline is not None:
+                deadline.cancel()
+
+    def iter_records(self, format='ndjson', batch=1024):
+        """Iterate over lists of at most batch records, decoded as the data
+        comes in.
+
+        format is either 'ndjson' (one JSON document per line, empty lines
+        are skipped) or a struct format string for fixed-size binary records.
+        A whole chunk is decoded at once, so the per-record Python overhead
+        is amortized. An incomplete binary record left at EOF stays
+        available to read().
+        """
+        if format == 'ndjson':
+            decode = _decode_ndjson
+        else:
+            decode = _StructDecoder(format)
+        while True:
+            eof = self.closed
+            records, self._readline_buffer = decode(self._readline_buffer, eof)
+            for i in xrange(0, len(records), batch):
+                yield records[i:i + batch]
+            if eof:
+                return
+            self._readline_buffer += self._recv()
+
+
+class PtyPipe(Pipe):
+    """A Pipe on the master side of a pseudo-terminal."""
+
+    def _recv(self, size=64 * 1024):
+        try:
+            return Pipe._recv(self, size)
+        except OSError as e:
+            # Linux reports EIO instead of EOF once the slave side is closed.
+            if e.errno != errno.EIO:
+                raise
+            self.close()
+            return ''
+
+    def set_winsize(self, rows, cols):
+        fcntl.ioctl(self._fd, termios.TIOCSWINSZ,
+                    struct.pack('HHHH', rows, cols, 0, 0))
+
+
+def _open_pty():
+    master, slave = pty.openpty()
+    # hand over the output as it was written, without '\n' -> '\r\n'.
+    attrs = termios.tcgetattr(slave)
+    attrs[1] &= ~termios.OPOST
+    termios.tcsetattr(slave, termios.TCSANOW, attrs)
+    fcntl.fcntl(master, fcntl.F_SETFD, fcntl.FD_CLOEXEC)
+    return master, slave
+
+
+_MFD_CLOEXEC = 0x1
+_MFD_ALLOW_SEALING = 0x2
+_F_ADD_SEALS = 1033
+# F_SEAL_SEAL | F_SEAL_SHRINK | F_SEAL_GROW | F_SEAL_WRITE
+_F_SEAL_ALL = 0x1 | 0x2 | 0x4 | 0x8
+
+
+def _memfd(name, data=None):
+    """Create a memfd, filled with data and sealed if data is given."""
+    if _libc is None or not hasattr(_libc, 'memfd_create'):
+        raise OSError(errno.ENOSYS, "memfd_create is not available")
+    fd = _libc.memfd_create(name, _MFD_CLOEXEC | _MFD_ALLOW_SEALING)
+    if fd < 0:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err))
+    if data is not None:
+        try:
+            offset = 0
+            while offset < len(data):
+                offset += os.write(fd, buffer(data, offset))
+            os.lseek(fd, 0, os.SEEK_SET)
+            fcntl.fcntl(fd, _F_ADD_SEALS, _F_SEAL_ALL)
+        except:
+            os.close(fd)
+            raise
+    return fd
+
+
+class _MemfdHolder(object):
+    """Own a memfd until it is closed, or until the holder is collected."""
+
+    def __init__(self, fd):
+        self.fd = fd
+
+    def close(self):
+        fd, self.fd = self.fd, None
+        if fd is not None:
+            os.close(fd)
+
+    def __del__(self):
+        self.close()
+
+
+class TeeConsumer(object):
+    """One of the outputs of Pipe.tee.
+
+    get() returns the next chunk, or an empty string at EOF. If the pipe
+    could not be read to the end, get() raises the error instead of
+    returning EOF. dropped and spilled count the bytes that the slow
+    consumer policy had to drop or to spill to disk.
+    """
+
+    def __init__(self, maxsize, policy):
+        if policy not in ('block', 'drop', 'spill'):
+            raise ValueError("unknown slow consumer policy: %r" % (policy,))
+        self._queue = Queue(maxsize)
+        self._policy = policy
+        self._eof = False
+        self._error = None
+        self._spill = None
+        self._spill_read = 0
+        self._spill_write = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def _spilling(self):
+        return self._spill_read != self._spill_write
+
+    def _put(self, chunk):
+        if self._policy == 'block':
+            self._queue.put(chunk)
+            return
+        if not self._spilling():
+            try:
+                self._queue.put_nowait(chunk)
+                return
+            except Full:
+                pass
+        if self._policy == 'drop':
+            self.dropped += len(chunk)
+            return
+        if self._spill is None:
+            self._spill = tempfile.TemporaryFile()
+        self._spill.seek(self._spill_write)
+        self._spill.write(chunk)
+        self._spill_write += len(chunk)
+        self.spilled += len(chunk)
+
+    def _put_eof(self, error=None):
+        self._error = error
+        self._eof = True
+        if self._policy == 'block':
+            self._queue.put('')
+        elif not self._spilling():
+            try:
+                self._queue.put_nowait('')
+            except Full:
+                pass
+
+    def _unspill(self):
+        self._spill.seek(self._spill_read)
+        chunk = self._spill.read(min(64 * 1024,
+                                     self._spill_write - self._spill_read))
+        self._spill_read += len(chunk)
+        if not self._spilling():
+            self._spill.truncate(0)
+            self._spill_read = self._spill_write = 0
+        return chunk
+
+    def get(self):
+        if not self._queue.empty():
+            chunk = self._queue.get()
+        elif self._spilling():
+            return self._unspill()
+        elif self._eof:
+            chunk = ''
+        else:
+            chunk = self._queue.get()
+        if len(chunk) == 0 and self._error is not None:
+            raise self._error
+        return chunk
+
+    def read(self):
+        chunks = []
+        while True:
+            chunk = self.get()
+            if len(chunk) == 0:
+                break
+            chunks.append(chunk)
+        return ''.join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.get()
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+_json_decoder = json.JSONDecoder()
+
+
+def _decode_ndjson(data, eof):
+    end = len(data) if eof else data.rfind('\n') + 1
+    raw_decode = _json_decoder.raw_decode
+    records = []
+    for line in data[:end].split('\n'):
+        line = line.strip(' \t\r')
+        if len(line) == 0:
+            continue
+        # each line must hold exactly one document, nothing may follow it.
+        record, stop = raw_decode(line)
+        if stop != len(line):
+            raise ValueError('Extra data after the JSON document: %r'
+                             % (line,))
+        records.append(record)
+    return records, data[end:]
+
+
+class _StructDecoder(object):
+
+    def __init__(self, format):
+        self._struct = struct.Struct(format)
+
+    def __call__(self, data, eof):
+        size = self._struct.size
+        end = len(data) - len(data) % size
+        unpack_from = self._struct.unpack_from
+        records = [unpack_from(data, offset)
+                   for offset in xrange(0, end, size)]
+        return records, data[end:]
+
+
+# Every Popen from its creation until it is reaped, see process_table.
+_live = weakref.WeakSet()
+
+
+def process_table():
+    """Return a snapshot of the live children, oldest first.
+
+    Each child is a dict with its pid, args, age (in seconds), state
+    ('spawning', 'running', 'draining' while communicate collects the
+    outputs, 'reaping' while waiting for the exit), owner (the repr of the
+    greenlet that started it, None once that greenlet is gone) and the
+    bytes that went through its stdin, stdout and stderr (None without a
+    pipe). It is cheap enough to be served on a debug endpoint.
+    """
+    now = time.time()
+    table = []
+    for p in list(_live):
+        process = p._process
+        owner = p._owner()
+        entry = {
+            'pid': process.pid if process is not None else None,
+            'args': p._args,
+            'age': now - p._started,
+            'state': p._state,
+            'owner': repr(owner) if owner is not None else None,
+        }
+        for name in ('stdin', 'stdout', 'stderr'):
+            pipe = getattr(process, name, None)
+            entry[name] = pipe.stats.bytes if pipe is not None else None
+        table.append(entry)
+    table.sort(key=lambda entry: entry['age'], reverse=True)
+    return table
+
+
+class _ExecutableCache(object):
+    """Resolve bare command names against PATH in the parent.
+
+    The child then execs an absolute path at once, instead of trying every
+    PATH entry in turn, and an unknown command fails without forking. An
+    entry is kept along with the mtimes of the directories that were
+    looked at, any file added or removed there invalidates it.
+    """
+
+    def __init__(self, maxsize=1024):
+        self._maxsize = maxsize
+        self._entries = {}
+
+    @staticmethod
+    def _mtime(directory):
+        try:
+            return os.stat(directory).st_mtime
+        except OSError:
+            return None
+
+    def _lookup(self, name, dirs):
+        # a file that is there but not executable can become executable
+        # without touching its directory: the result is then not cached.
+        mtimes = []
+        denied = False
+        for directory in dirs:
+            mtimes.append((directory, self._mtime(directory)))
+            fullname = os.path.join(directory, name)
+            if os.path.isfile(fullname):
+                if os.access(fullname, os.X_OK):
+                    return fullname, mtimes, denied
+                denied = True
+        return None, mtimes, denied
+
+    def resolve(self, name, path):
+        """Return the absolute path of the executable name, None when it
+        cannot be resolved in the parent, or raise OSError(ENOENT), or
+        OSError(EACCES) if only non executable files were found, as execvp
+        would.
+        """
+        dirs = path.split(os.pathsep)
+        # relative entries depend on the cwd of the child, leave them to
+        # execvp.
+        if not all(os.path.isabs(directory) for directory in dirs):
+            return None
+        key = (path, name)
+        entry = self._entries.get(key)
+        if entry is None or any(self._mtime(directory) != mtime
+                                for directory, mtime in entry[1]):
+            self._entries.pop(key, None)
+            entry = self._lookup(name, dirs)
+            if not entry[2]:
+                if len(self._entries) >= self._maxsize:
+                    self._entries.clear()
+                self._entries[key] = entry
+        if entry[0] is None:
+            err = errno.EACCES if entry[2] else errno.ENOENT
+            raise OSError(err, os.strerror(err), name)
+        return entry[0]
+
+
+_executables = _ExecutableCache()
+
+
+# close_range(2) has the same number on every Linux architecture.
+_NR_close_range = 436
+
+
+def _close_range(low, high):
+    if _syscall is None or not sys.platform.startswith('linux'):
+        return False
+    return _syscall(_NR_close_range, ctypes.c_uint(low), ctypes.c_uint(high),
+                    ctypes.c_uint(0)) == 0
+
+
+def _close_fds_except(keep):
+    """Close every fd above 2 but the ones in keep (a sorted list), with as
+    many syscalls as there are gaps, or as there are open fds, instead of
+    as many as the fd limit allows.
+    """
+    low = 3
+    for fd in keep + [0xffffffff + 1]:
+        if fd > low and not _close_range(low, fd - 1):
+            break
+        low = max(low, fd + 1)
+    else:
+        return
+    try:
+        fds = [int(fd) for fd in os.listdir('/proc/self/fd')]
+    except OSError:
+        for fd in keep + [_subprocess.MAXFD]:
+            if fd > low:
+                os.closerange(low, fd)
+            low = max(low, fd + 1)
+        return
+    keep = set(keep)
+    for fd in fds:
+        if fd >= low and fd not in keep:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
 
 class _PopenWithAsyncPipe(_subprocess.Popen):
     def __init__(self, args, bufsize=0, executable=None,
                  stdin=None, stdout=None, stderr=None,
                  preexec_fn=None, close_fds=False, shell=False,
                  cwd=None, env=None, universal_newlines=False,
-                 startupinfo=None, creationflags=0):
+                 startupinfo=None, creationflags=0, pass_fds=(),
+                 memfd_input=None):
         """Create new Popen instance."""
         _subprocess._cleanup()
 
+        # computed here, there is no need to allocate after the fork.
+        self._pass_fds = sorted(set(pass_fds))
+        if pass_fds:
+            close_fds = True
+
         self._child_created = False
         if not isinstance(bufsize, (int, long)):
             raise TypeError("bufsize must be an integer")
@@ -169,6 +980,13 @@ class _PopenWithAsyncPipe(_subprocess.Popen):
                 raise ValueError("creationflags is only supported on Windows "
                                  "platforms")
 
+        if not _subprocess.mswindows and not shell and executable is None:
+            name = args if isinstance(args, basestring) else args[0]
+            if os.sep not in name:
+                path = (os.environ if env is None else env).get('PATH',
+                                                                os.defpath)
+                executable = _executables.resolve(name, path)
+
         self.stdin = None
         self.stdout = None
         self.stderr = None
@@ -191,6 +1009,32 @@ class _PopenWithAsyncPipe(_subprocess.Popen):
         # are None when not using PIPEs. The child objects are None
         # when not redirecting.
 
+        # The slave side of a PTY is handed to the child like any file
+        # descriptor, the master side is our end of the "pipe". A memfd is
+        # handed to the child as is, and stdout is kept to be mapped later,
+        # or closed with the Popen if it never was.
+        if stdin == PTY:
+            raise ValueError("PTY is only supported for stdout and stderr")
+        if stderr == MEMFD:
+            raise ValueError("MEMFD is only supported for stdin and stdout")
+        if memfd_input is not None and stdin != MEMFD:
+            raise ValueError("memfd_input requires stdin=MEMFD")
+        stdout_master = stderr_master = None
+        self._memfd_stdout = None
+        child_only_fds = []
+        if stdout == PTY:
+            stdout_master, stdout = _open_pty()
+            child_only_fds.append(stdout)
+        if stderr == PTY:
+            stderr_master, stderr = _open_pty()
+            child_only_fds.append(stderr)
+        if stdin == MEMFD:
+            stdin = _memfd('stdin', memfd_input or '')
+            child_only_fds.append(stdin)
+        if stdout == MEMFD:
+            stdout = _memfd('stdout')
+            self._memfd_stdout = _MemfdHolder(stdout)
+
         handles = self._get_handles(stdin, stdout, stderr)
         to_close = None
 
@@ -214,9 +1058,21 @@ class _PopenWithAsyncPipe(_subprocess.Popen):
         if to_close is not None:
             exec_kwargs["to_close"] = to_close
 
-        self._execute_child(args, executable, preexec_fn, close_fds,
-                            cwd, env, universal_newlines,
-                            startupinfo, creationflags, shell, **exec_kwargs)
+        try:
+            self._execute_child(args, executable, preexec_fn, close_fds,
+                                cwd, env, universal_newlines,
+                                startupinfo, creationflags, shell,
+                                **exec_kwargs)
+        except:
+            for fd in (stdout_master, stderr_master):
+                if fd is not None:
+                    os.close(fd)
+            if self._memfd_stdout is not None:
+                self._memfd_stdout.close()
+            raise
+        finally:
+            for fd in child_only_fds:
+                os.close(fd)
 
         if _subprocess.mswindows:
             if p2cwrite is not None:
@@ -238,6 +1094,26 @@ class _PopenWithAsyncPipe(_subprocess.Popen):
                 self.stderr = Pipe(errread, 'rU', bufsize)
             else:
                 self.stderr = Pipe(errread, 'rb', bufsize)
+        if stdout_master is not None:
+            self.stdout = PtyPipe(stdout_master, 'rb', bufsize)
+        if stderr_master is not None:
+            self.stderr = PtyPipe(stderr_master, 'rb', bufsize)
+
+
+    def _close_fds(self, but):
+        # runs in the child, between fork and exec.
+        for fd in self._pass_fds:
+            self._set_cloexec_flag(fd, False)
+        _close_fds_except(sorted(self._pass_fds + [but]))
+
+
+def _spawn_in_thread(*popen_args):
+    # the error is handed back to the greenlet rather than raised in the
+    # thread, where gevent would report it on stderr on top of it.
+    try:
+        return _PopenWithAsyncPipe(*popen_args), None
+    except:
+        return None, sys.exc_info()
 
 
 class Popen(object):
@@ -246,11 +1122,44 @@ class Popen(object):
             stdout=None, stderr=None, preexec_fn=None,
             close_fds=True,  # Like in Python 3.2, close_fds is now True by default.
             shell=False, cwd=None, env=None, universal_newlines=False,
-            startupinfo=None, creationflags=0):
-
-            self._process = _PopenWithAsyncPipe(args, bufsize, executable, stdin,
-                    stdout, stderr, preexec_fn, close_fds, shell, cwd, env,
-                    universal_newlines, startupinfo, creationflags)
+            startupinfo=None, creationflags=0, pass_fds=(),
+            priority=PRIORITY_NORMAL, spawn_in_thread=False,
+            memfd_input=None):
+
+            self._args = args
+            self._process = None
+            self._state = 'spawning'
+            self._started = time.time()
+            self._owner = weakref.ref(gevent.getcurrent())
+            _live.add(self)
+
+            popen_args = (args, bufsize, executable, stdin, stdout, stderr,
+                    preexec_fn, close_fds, shell, cwd, env, universal_newlines,
+                    startupinfo, creationflags, pass_fds,
+                    memfd_input)
+            try:
+                if spawn_in_thread:
+                    # fork, exec and the wait for the exec result happen in
+                    # a native thread, the hub keeps serving the other
+                    # greenlets.
+                    self._process, exc_info = \
+                        gevent.get_hub().threadpool.apply(_spawn_in_thread,
+                                                          popen_args)
+                    if exc_info is not None:
+                        raise exc_info[0], exc_info[1], exc_info[2]
+                else:
+                    self._process = _PopenWithAsyncPipe(*popen_args)
+            except:
+                _live.discard(self)
+                raise
+            self._state = 'running'
+            for pipe in (self.stdin, self.stdout, self.stderr):
+                if pipe is not None:
+                    pipe.priority = priority
+            self._communication = None
+            self._stdout_chunks = None
+            self._memfd_stdout = self._process._memfd_stdout is not None
+            self._memfd_view = None
 
         def _set_return_code(self, value):
             self._process.returncode = value
@@ -263,18 +1172,86 @@ class Popen(object):
         def returncode(self):
             return self._process.returncode
 
-        def poll(self):
-            return self._process.poll()
+        def _set_state(self, state):
+            if self._state != 'exited':
+                self._state = state
 
-        def wait(self):
-            sleep_duration = 0.01
-            while True:
-                r = self._process.poll()
-                if r is not None:
-                    return self.returncode
-                gevent.sleep(sleep_duration)
-                if sleep_duration < 0.5:
-                    sleep_duration *= 2
+        def _reaped(self):
+            self._state = 'exited'
+            _live.discard(self)
+
+        def poll(self):
+            r = self._process.poll()
+            if r is not None:
+                self._reaped()
+            return r
+
+        def wait(self, timeout=None):
+            deadline = None
+            if timeout is not None:
+                wakeup = Event()
+                deadline = _deadlines.schedule(timeout, wakeup.set)
+            previous_state = self._state
+            self._set_state('reaping')
+            try:
+                sleep_duration = 0.01
+                while True:
+                    r = self.poll()
+                    if r is not None:
+                        return self.returncode
+                    if deadline is None:
+                        gevent.sleep(sleep_duration)
+                    elif deadline.expired:
+                        raise TimeoutExpired(self._args, timeout)
+                    else:
+                        wakeup.wait(sleep_duration)
+                    if sleep_duration < 0.5:
+                        sleep_duration *= 2
+            finally:
+                self._set_state(previous_state)
+                if deadline is not None:
+                    deadline.cancel()
+
+        def memfd_output(self):
+            """Wait for a child started with stdout=MEMFD, and return its
+            output as a read-only mmap (an empty string if there was none).
+            """
+            if not self._memfd_stdout:
+                raise ValueError("stdout is not a memfd")
+            if self._memfd_view is None:
+                holder = self._process._memfd_stdout
+                fd = holder.fd
+                self.wait()
+                try:
+                    size = os.fstat(fd).st_size
+                    if size == 0:
+                        self._memfd_view = ''
+                    else:
+                        self._memfd_view = mmap.mmap(fd, size, mmap.MAP_SHARED,
+                                                     mmap.PROT_READ)
+                finally:
+                    holder.close()
+                    self._process._memfd_stdout = None
+            return self._memfd_view
+
+        def escalate(self, sequence=None):
+            """Send the signals of sequence (ESCALATION by default) in turn,
+            waiting for their grace period, until the child exits.
+
+            Return the returncode, or None if the child outlived the whole
+            sequence.
+            """
+            if sequence is None:
+                sequence = ESCALATION
+            for sig, grace in sequence:
+                if self.poll() is not None:
+                    break
+                self.send_signal(sig)
+                try:
+                    return self.wait(grace)
+                except TimeoutExpired:
+                    pass
+            return self.poll()
 
         def send_signal(self, signal):
             self._process.send_signal(signal)
@@ -297,43 +1274,132 @@ class Popen(object):
         def stderr(self):
             return self._process.stderr
 
-        def communicate(self, input=None):
+        def _start_communication(self, input, compress):
+            writer = reader_stdout = reader_stderr = None
+
             if self.stdin is not None:
+                # input is either a string or an iterable of chunks. A chunk
+                # is pulled only once the previous one has been written, so
+                # the input is produced at the pace of the child.
                 def _writer():
-                    self.stdin.write(input)
-                    self.stdin.close()
+                    try:
+                        if isinstance(input, (basestring, bytearray, buffer,
+                                              memoryview)):
+                            if len(input) != 0:
+                                self.stdin.write(input)
+                        elif input is not None:
+                            for chunk in input:
+                                self.stdin.write(chunk)
+                    finally:
+                        self.stdin.close()
                 writer = gevent.spawn(_writer)
 
             if self.stdout is not None:
-                reader_stdout = gevent.spawn(self.stdout.read)
+                if compress is None:
+                    self._stdout_chunks = []
+                    reader_stdout = gevent.spawn(_collect, self.stdout,
+                                                 self._stdout_chunks)
+                else:
+                    reader_stdout = gevent.spawn(self.stdout.read_compressed,
+                                                 compress)
 
             if self.stderr is not None:
-                reader_stderr = gevent.spawn(self.stderr.read)
+                if compress is None:
+                    reader_stderr = gevent.spawn(self.stderr.read)
+                else:
+                    reader_stderr = gevent.spawn(self.stderr.read_compressed,
+                                                 compress)
+
+            return (writer, reader_stdout, reader_stderr)
+
+        def communicate(self, input=None, timeout=None, compress=None):
+            # the greenlets are kept around, so that after a TimeoutExpired,
+            # communicate can be called again without losing any output.
+            # With compress ('zlib', 'gzip' or 'lzma'), the outputs are
+            # compressed on the fly and returned as CompressedOutput.
+            if self._communication is None:
+                if compress is not None:
+                    # reject an unknown method before any greenlet is started.
+                    _compressor(compress)
+                self._communication = self._start_communication(input,
+                                                                compress)
+            writer, reader_stdout, reader_stderr = self._communication
+            self._set_state('draining')
+
+            if timeout is not None:
+                endtime = _monotonic() + timeout
+                pending = [g for g in self._communication if g is not None]
+                done = Event()
+
+                def _check_done(unused=None):
+                    if all(g.ready() for g in pending):
+                        done.set()
+
+                deadline = _deadlines.schedule(timeout, done.set)
+                for g in pending:
+                    g.rawlink(_check_done)
+                try:
+                    _check_done()
+                    done.wait()
+                finally:
+                    deadline.cancel()
+                    for g in pending:
+                        g.unlink(_check_done)
+                if not all(g.ready() for g in pending):
+                    raise TimeoutExpired(self._args, timeout)
 
             stdoutdata = None
-            if self.stdout is not None:
+            if reader_stdout is not None:
                 stdoutdata = reader_stdout.get()
 
             stderrdata = None
-            if self.stderr is not None:
+            if reader_stderr is not None:
                 stderrdata = reader_stderr.get()
 
-            if self.stdin:
+            if writer is not None:
                 writer.get()
 
-            self.wait()
+            if timeout is not None:
+                self.wait(max(0, endtime - _monotonic()))
+            else:
+                self.wait()
+            if self._memfd_stdout:
+                stdoutdata = self.memfd_output()[:]
             return (stdoutdata, stderrdata)
 
+        def _stdout_so_far(self):
+            # what communicate read from stdout until now, without waiting.
+            if self._stdout_chunks is None:
+                return None
+            return ''.join(self._stdout_chunks)
+
+
+def _collect(pipe, chunks):
+    # the chunks stay reachable from the outside while the pipe is read.
+    while not pipe.closed:
+        chunks.append(pipe.read(greedy=False))
+    return ''.join(chunks)
+
 
 def call(*popenargs, **kwargs):
-    """Run command with arguments.  Wait for command to complete, then
-    return the returncode attribute.
+    """Run command with arguments.  Wait for command to complete or
+    timeout, then return the returncode attribute.
 
-    The arguments are the same as for the Popen constructor.  Example:
+    The arguments are the same as for the Popen constructor, plus timeout
+    and escalation. When the timeout expires, the child is put down with
+    the escalation signal sequence (ESCALATION by default) and
+    TimeoutExpired is raised.  Example:
 
     retcode = call(["ls", "-l"])
     """
-    return Popen(*popenargs, **kwargs).wait()
+    timeout = kwargs.pop('timeout', None)
+    escalation = kwargs.pop('escalation', None)
+    p = Popen(*popenargs, **kwargs)
+    try:
+        return p.wait(timeout)
+    except TimeoutExpired:
+        p.escalate(escalation)
+        raise
 
 
 def check_call(*popenargs, **kwargs):
@@ -360,7 +1426,9 @@ def check_output(*popenargs, **kwargs):
 
     If the exit code was non-zero it raises a CalledProcessError.  The
     CalledProcessError object will have the return code in the returncode
-    attribute and output in the output attribute.
+    attribute and output in the output attribute. If the timeout expires,
+    the child is put down like with call and TimeoutExpired is raised with
+    the output collected so far.
 
     The arguments are the same as for the Popen constructor.  Example:
 
@@ -377,12 +1445,102 @@ def check_output(*popenargs, **kwargs):
     """
     if 'stdout' in kwargs:
         raise ValueError('stdout argument not allowed, it will be overridden.')
+    timeout = kwargs.pop('timeout', None)
+    escalation = kwargs.pop('escalation', None)
     process = Popen(stdout=PIPE, *popenargs, **kwargs)
-    output, unused_err = process.communicate()
+    cmd = kwargs.get("args")
+    if cmd is None:
+        cmd = popenargs[0]
+    try:
+        output, unused_err = process.communicate(timeout=timeout)
+    except TimeoutExpired:
+        # like CPython, never wait for EOF again: a grandchild may well keep
+        # stdout open long after the child is gone.
+        process.escalate(escalation)
+        raise TimeoutExpired(cmd, timeout, output=process._stdout_so_far())
     retcode = process.poll()
     if retcode:
-        cmd = kwargs.get("args")
-        if cmd is None:
-            cmd = popenargs[0]
         raise CalledProcessError(retcode, cmd, output=output)
     return output
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode(sys.getfilesystemencoding() or 'utf-8')
+    return value
+
+
+class Command(object):
+    """A command line prefix and a set of Popen arguments, checked and
+    prepared once, to be spawned many times.
+
+    The arguments and the environment are copied and encoded, and a bare
+    command name is resolved in PATH, at construction time. The command is
+    only resolved again for a spawn that overrides shell, env or
+    executable. Example:
+
+    >>> ls = Command(["ls", "-d"], cwd="/", stdout=PIPE)
+    >>> ls.check_output(["tmp"])
+    'tmp\n'
+    """
+
+    _popen_arguments = frozenset(inspect.getargspec(Popen.__init__).args[2:])
+    _resolution_overrides = frozenset(['shell', 'env', 'executable'])
+
+    def __init__(self, args, **kwargs):
+        unknown = set(kwargs) - self._popen_arguments
+        if unknown:
+            raise TypeError("unexpected Popen arguments: %s"
+                            % ', '.join(sorted(unknown)))
+        if isinstance(args, basestring):
+            args = [args]
+        self._args = [_encode(arg) for arg in args]
+
+        env = kwargs.get('env')
+        if env is not None:
+            kwargs['env'] = dict((_encode(k), _encode(v))
+                                 for k, v in env.iteritems())
+        self._kwargs = kwargs
+        self._resolved = self._executable(self._args, kwargs)
+
+    @staticmethod
+    def _executable(args, kwargs):
+        if kwargs.get('shell', False) or \
+                kwargs.get('executable') is not None or os.sep in args[0]:
+            return kwargs.get('executable')
+        env = kwargs.get('env')
+        path = (os.environ if env is None else env).get('PATH', os.defpath)
+        return _executables.resolve(args[0], path)
+
+    def _popen_args(self, extra_args, overrides):
+        kwargs = dict(self._kwargs)
+        kwargs.update(overrides)
+        args = self._args
+        if extra_args:
+            if kwargs.get('shell', False):
+                raise ValueError("extra arguments are not supported "
+                                 "with shell=True")
+            args = args + [_encode(arg) for arg in extra_args]
+        if self._resolution_overrides.isdisjoint(overrides):
+            kwargs['executable'] = self._resolved
+        else:
+            kwargs['executable'] = self._executable(args, kwargs)
+        return args, kwargs
+
+    def spawn(self, extra_args=(), **overrides):
+        """Start the command with extra_args appended, return the Popen."""
+        args, kwargs = self._popen_args(extra_args, overrides)
+        return Popen(args, **kwargs)
+
+    def call(self, extra_args=(), **overrides):
+        args, kwargs = self._popen_args(extra_args, overrides)
+        return call(args, **kwargs)
+
+    def check_call(self, extra_args=(), **overrides):
+        args, kwargs = self._popen_args(extra_args, overrides)
+        return check_call(args, **kwargs)
+
+    def check_output(self, extra_args=(), **overrides):
+        args, kwargs = self._popen_args(extra_args, overrides)
+        kwargs.pop('stdout', None)
+        return check_output(args, **kwargs)
@@ -0,0 +1,538 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2012 François-Xavier Bourlet (bombela@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""Run children from a set of supervisor processes.
+
+Each supervisor is a Python process with its own hub, that spawns, pumps
+and reaps the children it is assigned. The pipe I/O of output-heavy
+children is then spread over as many cores as there are supervisors. The
+caller talks to them over Unix sockets, through a Popen-like proxy.
+"""
+
+import os
+import sys
+import time
+import signal
+import socket
+import struct
+import itertools
+import multiprocessing
+import cPickle as pickle
+
+import gevent
+from gevent.event import Event, AsyncResult
+from gevent.queue import Queue
+
+from .gevent_subprocess import Popen, Pipe, PIPE, STDOUT, TimeoutExpired, \
+    _deadlines, _monotonic
+
+_header = struct.Struct('!I')
+
+
+def _frame(message):
+    # pickled by the sender, so that an unpicklable message fails there
+    # instead of killing the send loop.
+    data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+    return _header.pack(len(data)) + data
+
+
+def _send_loop(pipe, outbox):
+    # a single writer per socket, so that messages never interleave.
+    for frame in outbox:
+        pipe.write(frame)
+
+
+def _receive(pipe):
+    header = pipe.read(_header.size)
+    if len(header) < _header.size:
+        return None
+    size, = _header.unpack(header)
+    return pickle.loads(pipe.read(size))
+
+
+class _Worker(object):
+
+    def __init__(self, fd):
+        self._pipe = Pipe(fd)
+        self._outbox = Queue()
+        self._procs = {}
+        self._stdins = {}
+
+    def _send(self, message):
+        try:
+            frame = _frame(message)
+        except Exception as e:
+            # only the exception of 'error' and 'eof' can be exotic.
+            message = message[:-1] + (RuntimeError(
+                'unpicklable %r: %s' % (message[-1], e)),)
+            frame = _frame(message)
+        self._outbox.put(frame)
+
+    def run(self):
+        gevent.spawn(_send_loop, self._pipe, self._outbox)
+        while True:
+            try:
+                message = _receive(self._pipe)
+            except Exception:
+                # a truncated frame, the caller went away.
+                break
+            if message is None:
+                break
+            getattr(self, '_on_' + message[0])(*message[1:])
+        # nobody is left to collect the results.
+        for p in self._procs.values():
+            try:
+                p.kill()
+            except OSError:
+                pass
+
+    def _on_spawn(self, id, args, kwargs):
+        try:
+            p = Popen(args, **kwargs)
+        except Exception as e:
+            self._send(('error', id, e))
+            return
+        self._procs[id] = p
+        self._send(('started', id, p.pid))
+        if p.stdin is not None:
+            self._stdins[id] = Queue()
+            gevent.spawn(self._pump_stdin, id, p.stdin, self._stdins[id])
+        for name in ('stdout', 'stderr'):
+            pipe = getattr(p, name)
+            if pipe is not None:
+                gevent.spawn(self._pump_output, id, name, pipe)
+        gevent.spawn(self._reap, id, p)
+
+    def _reap(self, id, p):
+        # the exit is reported on its own, whatever happens to the streams.
+        returncode = p.wait()
+        del self._procs[id]
+        queue = self._stdins.get(id)
+        if queue is not None:
+            # what is still to come could only fail with EPIPE.
+            queue.put(StopIteration)
+        self._send(('exited', id, returncode))
+
+    def _pump_stdin(self, id, pipe, queue):
+        try:
+            for data in queue:
+                pipe.write(data)
+        except IOError:
+            # the child does not read anymore, the rest is dropped.
+            pass
+        finally:
+            del self._stdins[id]
+            pipe.close()
+
+    def _pump_output(self, id, name, pipe):
+        error = None
+        try:
+            while not pipe.closed:
+                data = pipe.read(greedy=False)
+                if len(data) != 0:
+                    self._send(('data', id, name, data))
+        except Exception as e:
+            error = e
+        self._send(('eof', id, name, error))
+
+    def _on_write(self, id, data):
+        queue = self._stdins.get(id)
+        if queue is not None:
+            queue.put(data)
+
+    def _on_close(self, id):
+        queue = self._stdins.get(id)
+        if queue is not None:
+            queue.put(StopIteration)
+
+    def _on_signal(self, id, signum):
+        p = self._procs.get(id)
+        if p is not None and p.returncode is None:
+            p.send_signal(signum)
+
+
+def main(fd):
+    _Worker(fd).run()
+
+
+class _RemoteInput(object):
+    """The stdin of a supervised child: every write is forwarded to the
+    supervisor, which writes it to the child at its own pace.
+    """
+
+    def __init__(self, shard, id):
+        self._shard = shard
+        self._id = id
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed file")
+        # pickled here, so that the caller gets the error.
+        self._shard.send(('write', self._id, data))
+
+    def writelines(self, sequence):
+        for line in sequence:
+            self.write(line)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._shard.send(('close', self._id))
+
+
+class _RemoteOutput(object):
+    """The stdout or stderr of a supervised child, made of the chunks the
+    supervisor forwards as it reads them.
+    """
+
+    def __init__(self):
+        self._chunks = Queue()
+        self._buffer = ''
+        self._error = None
+        self.closed = False
+
+    def _put(self, data):
+        self._chunks.put(data)
+
+    def _put_eof(self, error=None):
+        self._error = error
+        self._chunks.put(None)
+
+    def _more(self, parts):
+        if self.closed:
+            return False
+        chunk = self._chunks.get()
+        if chunk is None:
+            self.closed = True
+            if self._error is not None:
+                raise self._error
+            return False
+        parts.append(chunk)
+        return True
+
+    def read(self, size=-1):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        try:
+            while (size < 0 or length < size) and self._more(parts):
+                length += len(parts[-1])
+        except:
+            self._buffer = ''.join(parts)
+            raise
+        data = ''.join(parts)
+        self._buffer = ''
+        if size >= 0:
+            data, self._buffer = data[:size], data[size:]
+        return data
+
+    def readline(self, size=-1):
+        parts = [self._buffer]
+        length = len(self._buffer)
+        try:
+            while '\n' not in parts[-1] and (size < 0 or length < size) \
+                    and self._more(parts):
+                length += len(parts[-1])
+        except:
+            self._buffer = ''.join(parts)
+            raise
+        data = ''.join(parts)
+        end = data.find('\n') + 1 or len(data)
+        if size >= 0:
+            end = min(end, size)
+        self._buffer = data[end:]
+        return data[:end]
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if len(line) == 0:
+                break
+            yield line
+
+
+class SupervisedPopen(object):
+    """The proxy of a child run by a supervisor process.
+
+    The supervisor pumps the pipes of the child as soon as it starts, and
+    forwards what it reads to stdout and stderr, so that the child cannot
+    block on a full pipe whatever the caller does. Writes to stdin are
+    forwarded the same way. The exit is reported as soon as the supervisor
+    reaps the child.
+    """
+
+    def __init__(self, shard, id, args, kwargs):
+        self._shard = shard
+        self._id = id
+        self._args = args
+        self._started = AsyncResult()
+        self._exited = Event()
+        self._communication = None
+        self._input = None
+        self.pid = None
+        self.returncode = None
+        self.stdin = self.stdout = self.stderr = None
+        if kwargs.get('stdin') == PIPE:
+            self.stdin = _RemoteInput(shard, id)
+        if kwargs.get('stdout') == PIPE:
+            self.stdout = _RemoteOutput()
+        if kwargs.get('stderr') == PIPE:
+            self.stderr = _RemoteOutput()
+        self._outputs = dict((name, getattr(self, name))
+                             for name in ('stdout', 'stderr')
+                             if getattr(self, name) is not None)
+
+    def _start_communication(self, input):
+        writer = reader_stdout = reader_stderr = None
+        if self.stdin is not None:
+            def _writer():
+                try:
+                    if isinstance(input, (basestring, bytearray)):
+                        if len(input) != 0:
+                            self.stdin.write(input)
+                    elif input is not None:
+                        for chunk in input:
+                            self.stdin.write(chunk)
+                finally:
+                    self.stdin.close()
+            writer = gevent.spawn(_writer)
+        if self.stdout is not None:
+            reader_stdout = gevent.spawn(self.stdout.read)
+        if self.stderr is not None:
+            reader_stderr = gevent.spawn(self.stderr.read)
+        return (writer, reader_stdout, reader_stderr)
+
+    def _wait(self, event, timeout):
+        if timeout is None:
+            event.wait()
+            return
+        wakeup = Event()
+        _wakeup = lambda unused: wakeup.set()
+        deadline = _deadlines.schedule(timeout, wakeup.set)
+        event.rawlink(_wakeup)
+        try:
+            if not event.is_set():
+                wakeup.wait()
+        finally:
+            deadline.cancel()
+            event.unlink(_wakeup)
+        if not event.is_set():
+            raise TimeoutExpired(self._args, timeout)
+
+    def poll(self):
+        return self.returncode
+
+    def wait(self, timeout=None):
+        self._wait(self._exited, timeout)
+        return self.returncode
+
+    def communicate(self, input=None, timeout=None):
+        # like Popen.communicate, the greenlets are kept around so that it
+        # can be called again after a TimeoutExpired.
+        if self._communication is None:
+            self._input = input
+            self._communication = self._start_communication(input)
+        elif input is not None and self._input is None:
+            raise ValueError("communicate was already started without "
+                             "input, the input would be lost")
+        endtime = None
+        if timeout is not None:
+            endtime = _monotonic() + timeout
+        pending = [g for g in self._communication if g is not None]
+        done = Event()
+
+        def _check_done(unused=None):
+            if all(g.ready() for g in pending):
+                done.set()
+
+        for g in pending:
+            g.rawlink(_check_done)
+        try:
+            _check_done()
+            self._wait(done, timeout)
+        finally:
+            for g in pending:
+                g.unlink(_check_done)
+
+        writer, reader_stdout, reader_stderr = self._communication
+        stdoutdata = stderrdata = None
+        if reader_stdout is not None:
+            stdoutdata = reader_stdout.get()
+        if reader_stderr is not None:
+            stderrdata = reader_stderr.get()
+        if writer is not None:
+            writer.get()
+        if endtime is None:
+            self._wait(self._exited, None)
+        else:
+            self._wait(self._exited, max(0, endtime - _monotonic()))
+        return (stdoutdata, stderrdata)
+
+    def send_signal(self, signum):
+        if self.returncode is None:
+            self._shard.send(('signal', self._id, signum))
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class _Shard(object):
+
+    def __init__(self):
+        ours, theirs = socket.socketpair()
+        fd, child_fd = os.dup(ours.fileno()), os.dup(theirs.fileno())
+        ours.close()
+        theirs.close()
+        try:
+            self.process = Popen([sys.executable, '-c',
+                'import sys; sys.path.insert(0, %r); '
+                'from gevent_subprocess.supervisor import main; main(%d)'
+                % (os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                   child_fd)], pass_fds=[child_fd])
+        finally:
+            os.close(child_fd)
+        self._pipe = Pipe(fd)
+        self._outbox = Queue()
+        self._procs = {}
+        gevent.spawn(self._sender)
+        gevent.spawn(self._dispatch)
+
+    @property
+    def load(self):
+        return len(self._procs)
+
+    def send(self, message):
+        self._outbox.put(_frame(message))
+
+    def spawn(self, id, args, kwargs):
+        proc = SupervisedPopen(self, id, args, kwargs)
+        self.send(('spawn', id, args, kwargs))
+        self._procs[id] = proc
+        proc.pid = proc._started.get()
+        return proc
+
+    def _settle(self, id, proc):
+        if proc._exited.is_set() and not proc._outputs:
+            del self._procs[id]
+
+    def _sender(self):
+        _send_loop(self._pipe, self._outbox)
+        # the supervisor exits on EOF, after putting down its children.
+        sock = socket.fromfd(self._pipe.fileno(), socket.AF_UNIX,
+                             socket.SOCK_STREAM)
+        sock.shutdown(socket.SHUT_WR)
+        sock.close()
+
+    def _dispatch(self):
+        while True:
+            try:
+                message = _receive(self._pipe)
+            except Exception:
+                # a truncated frame, the supervisor died mid-message.
+                break
+            if message is None:
+                break
+            kind, id = message[:2]
+            proc = self._procs[id]
+            if kind == 'started':
+                proc._started.set(message[2])
+            elif kind == 'error':
+                del self._procs[id]
+                proc._started.set_exception(message[2])
+            elif kind == 'exited':
+                proc.returncode = message[2]
+                proc._exited.set()
+                self._settle(id, proc)
+            elif kind == 'data':
+                proc._outputs[message[2]]._put(message[3])
+            elif kind == 'eof':
+                proc._outputs.pop(message[2])._put_eof(message[3])
+                self._settle(id, proc)
+        # the supervisor went away with its children.
+        error = IOError('supervisor process %d exited' % self.process.pid)
+        for proc in self._procs.values():
+            if not proc._started.ready():
+                proc._started.set_exception(error)
+            for output in proc._outputs.values():
+                output._put_eof(error)
+            proc._outputs.clear()
+            proc._exited.set()
+        self._procs.clear()
+
+    def close(self):
+        self._outbox.put(StopIteration)
+        self.process.wait()
+
+
+class Supervisor(object):
+    """A set of n supervisor processes (one per core by default).
+
+    Children are assigned to the least loaded supervisor, or by hashing
+    their arguments with assign='hash'. Supervisors inherit the
+    environment and the current directory at the time they are started.
+    """
+
+    def __init__(self, n=None, assign='load'):
+        if assign not in ('load', 'hash'):
+            raise ValueError("unknown assignment: %r" % (assign,))
+        self._assign = assign
+        self._ids = itertools.count()
+        self._shards = [_Shard()
+                        for x in xrange(n or multiprocessing.cpu_count())]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _pick(self, args):
+        if self._assign == 'hash':
+            key = args if isinstance(args, basestring) else tuple(args)
+            return self._shards[hash(key) % len(self._shards)]
+        return min(self._shards, key=lambda shard: shard.load)
+
+    def Popen(self, args, **kwargs):
+        """Start a child in a supervisor, and return its SupervisedPopen.
+
+        The arguments are the same as for the Popen constructor, except that
+        only None, PIPE and STDOUT can be used for stdin, stdout and stderr,
+        and that preexec_fn, pass_fds, spawn_in_thread and memfd_input are
+        not supported: they only make sense in the calling process.
+        """
+        for name in ('stdin', 'stdout', 'stderr'):
+            if kwargs.get(name) not in (None, PIPE, STDOUT):
+                raise ValueError("%s must be None, PIPE or STDOUT" % name)
+        for name in ('preexec_fn', 'pass_fds', 'spawn_in_thread',
+                     'memfd_input'):
+            if kwargs.get(name):
+                raise ValueError("%s is not supported by supervisors" % name)
+        return self._pick(args).spawn(next(self._ids), args, kwargs)
+
+    def close(self):
+        for shard in self._shards:
+            shard.close()
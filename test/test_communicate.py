@@ -91,3 +91,139 @@ def test_communicate_nostdin():
     print 'stderr --\n', stderr
     assert stdout == '/tmp\n'
     assert stderr == ''
+
+def test_communicate_timeout():
+
+    print 'spawn /bin/sh...'
+    p = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    print 'communicate...'
+    try:
+        p.communicate('echo BEFORE\nsleep 1\necho AFTER\n', timeout=0.2)
+        assert False, 'TimeoutExpired not raised'
+    except subprocess.TimeoutExpired as e:
+        print e
+
+    print 'communicate again...'
+    stdout, stderr = p.communicate(timeout=10)
+    print 'stdout --\n', stdout
+    assert stdout == 'BEFORE\nAFTER\n'
+    assert stderr is None
+    assert p.returncode == 0
+
+def test_communicate_compress():
+    import zlib
+
+    print 'spawn /bin/sh...'
+    p = subprocess.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    print 'communicate...'
+    stdout, stderr = p.communicate('''
+head -c 1400000 /dev/zero
+echo DONE >&2
+''', compress='gzip')
+    print 'stdout size', stdout.size, 'compressed', len(stdout.data)
+    assert stdout.size == 1400000
+    assert len(stdout.data) < stdout.size / 100
+    assert zlib.decompress(stdout.data, 16 + zlib.MAX_WBITS) == \
+        '\0' * 1400000
+    assert stderr.size == len('DONE\n')
+    assert zlib.decompress(stderr.data, 16 + zlib.MAX_WBITS) == 'DONE\n'
+
+def test_communicate_compress_unknown():
+    from nose.tools import assert_raises
+
+    p = subprocess.Popen(['echo', 'hi'], stdout=subprocess.PIPE)
+    with assert_raises(ValueError):
+        p.communicate(compress='rar')
+    # nothing was started, the output is still there to be read.
+    assert p._communication is None
+    assert p._state == 'running'
+    assert p.communicate(timeout=5) == ('hi\n', None)
+    assert p.returncode == 0
+
+def test_communicate_generator_input():
+
+    produced = [0]
+    def chunks():
+        for x in xrange(320):
+            produced[0] += 1
+            yield 'x' * 64 * 1024
+
+    print 'spawn wc -c...'
+    p = subprocess.Popen(['wc', '-c'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    print 'communicate...'
+    stdout, stderr = p.communicate(chunks())
+    print 'stdout --\n', stdout
+    assert int(stdout) == 320 * 64 * 1024
+    assert produced[0] == 320
+
+def test_communicate_memfd():
+
+    data = 'hello memfd\n' * 100000
+    print 'spawn tr...'
+    p = subprocess.Popen(['tr', 'a-z', 'A-Z'], stdin=subprocess.MEMFD,
+            stdout=subprocess.MEMFD, memfd_input=data)
+    assert p.stdin is None
+    assert p.stdout is None
+
+    print 'communicate...'
+    stdout, stderr = p.communicate()
+    assert stdout == data.upper()
+    assert stderr is None
+    view = p.memfd_output()
+    assert len(view) == len(data)
+    assert view[:12] == 'HELLO MEMFD\n'
+
+def test_communicate_memfd_empty():
+
+    p = subprocess.Popen(['true'], stdin=subprocess.MEMFD,
+            stdout=subprocess.MEMFD)
+    assert p.communicate() == ('', None)
+    assert p.returncode == 0
+
+def test_memfd_invalid():
+    from nose.tools import assert_raises
+
+    with assert_raises(ValueError):
+        subprocess.Popen(['true'], stderr=subprocess.MEMFD)
+    with assert_raises(ValueError):
+        subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, memfd_input='lost')
+
+def test_memfd_wait_only():
+    import gc
+    import os
+
+    fds = len(os.listdir('/proc/self/fd'))
+    for x in xrange(20):
+        p = subprocess.Popen(['true'], stdout=subprocess.MEMFD)
+        assert p.wait() == 0
+    del p
+    gc.collect()
+    assert len(os.listdir('/proc/self/fd')) == fds
+
+def test_communicate_generator_input_raises():
+    from nose.tools import assert_raises
+
+    def chunks():
+        yield 'hello\n'
+        raise RuntimeError('no more input')
+
+    p = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+    with assert_raises(RuntimeError):
+        p.communicate(chunks(), timeout=10)
+    assert p.stdin.closed
+
+def test_communicate_bytearray_input():
+
+    p = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+    stdout, stderr = p.communicate(bytearray('hello'), timeout=10)
+    assert stdout == 'hello'
+    assert stderr is None
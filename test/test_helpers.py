@@ -22,6 +22,7 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import signal
 import gevent_subprocess as subprocess
 from nose.tools import assert_raises
 
@@ -43,3 +44,202 @@ def test_check_output():
     assert r == '/tmp\n'
     with assert_raises(OSError):
         subprocess.check_output('/donotexist/poorexec')
+
+def test_call_timeout():
+
+    with assert_raises(subprocess.TimeoutExpired):
+        subprocess.call('sleep 500'.split(' '), timeout=0.2,
+                escalation=((signal.SIGKILL, None),))
+    assert subprocess.call('true', timeout=5) == 0
+
+def test_check_output_timeout():
+
+    with assert_raises(subprocess.TimeoutExpired) as cm:
+        subprocess.check_output(['sh', '-c', 'echo started; exec sleep 500'],
+                timeout=0.5)
+    print cm.exception.output
+    assert cm.exception.output == 'started\n'
+    r = subprocess.check_output('echo done'.split(' '), timeout=5)
+    assert r == 'done\n'
+
+def test_check_output_timeout_grandchild():
+    import time
+
+    # the orphaned sleep keeps stdout open, that must not delay the timeout.
+    start = time.time()
+    with assert_raises(subprocess.TimeoutExpired) as cm:
+        subprocess.check_output(['sh', '-c', 'echo started; sleep 5 & wait'],
+                timeout=0.5)
+    elapsed = time.time() - start
+    print 'timed out after', elapsed
+    assert elapsed < 2
+    assert cm.exception.output == 'started\n'
+
+def test_executable_cache():
+    import os
+    import shutil
+    import tempfile
+    from gevent_subprocess.gevent_subprocess import _executables
+
+    bindir = tempfile.mkdtemp()
+    try:
+        env = {'PATH': bindir + os.pathsep + '/bin' + os.pathsep + '/usr/bin'}
+        with assert_raises(OSError):
+            subprocess.call('poorexec', env=env)
+        assert _executables.resolve('ls', env['PATH']).endswith('/ls')
+
+        print 'adding poorexec...'
+        script = os.path.join(bindir, 'poorexec')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\nexit 42\n')
+        os.chmod(script, 0755)
+        assert _executables.resolve('poorexec', env['PATH']) == script
+        assert subprocess.call('poorexec', env=env) == 42
+    finally:
+        shutil.rmtree(bindir)
+
+def test_executable_cache_chmod():
+    import errno
+    import os
+    import shutil
+    import tempfile
+
+    bindir = tempfile.mkdtemp()
+    try:
+        env = {'PATH': bindir}
+        script = os.path.join(bindir, 'poortool')
+        with open(script, 'w') as f:
+            f.write('#!/bin/sh\nexit 7\n')
+        os.chmod(script, 0644)
+        with assert_raises(OSError) as cm:
+            subprocess.call('poortool', env=env)
+        assert cm.exception.errno == errno.EACCES
+        # chmod leaves the mtime of the directory alone.
+        os.chmod(script, 0755)
+        assert subprocess.call('poortool', env=env) == 7
+    finally:
+        shutil.rmtree(bindir)
+
+def test_command():
+
+    ls = subprocess.Command(['ls', '-d'], cwd='/', stdout=subprocess.PIPE)
+    for x in xrange(10):
+        assert ls.check_output(['tmp']) == 'tmp\n'
+    p = ls.spawn(['tmp', 'usr'])
+    stdout, stderr = p.communicate()
+    assert stdout == 'tmp\nusr\n'
+
+    sh = subprocess.Command(['sh', '-c', 'exit $CODE'], env={u'CODE': u'3'})
+    assert sh.call() == 3
+    assert sh.call(env={'CODE': '4'}) == 4
+    with assert_raises(subprocess.CalledProcessError):
+        sh.check_call()
+
+    with assert_raises(TypeError):
+        subprocess.Command(['ls'], stdot=subprocess.PIPE)
+    with assert_raises(OSError):
+        subprocess.Command(['donotexist_poorexec'])
+
+def test_command_overrides():
+    import os
+    import shutil
+    import tempfile
+    from gevent_subprocess.gevent_subprocess import _executables
+
+    # the executable resolved for the defaults must not outlive them.
+    echo = subprocess.Command(['echo', 'hi'], stdout=subprocess.PIPE)
+    assert echo.spawn().communicate() == ('hi\n', None)
+    p = subprocess.Popen(['echo', 'hi'], shell=True, stdout=subprocess.PIPE)
+    expected = p.communicate()
+    assert echo.spawn(shell=True).communicate() == expected
+
+    bindirs = [tempfile.mkdtemp(), tempfile.mkdtemp()]
+    try:
+        for code, bindir in enumerate(bindirs):
+            script = os.path.join(bindir, 'poorexec')
+            with open(script, 'w') as f:
+                f.write('#!/bin/sh\nexit %d\n' % (code + 1))
+            os.chmod(script, 0755)
+        poorexec = subprocess.Command(['poorexec'],
+                                      env={'PATH': bindirs[0]})
+        assert poorexec.call() == 1
+        assert poorexec.call(env={'PATH': bindirs[1]}) == 2
+        assert poorexec.call(executable='/bin/true') == 0
+        # without those overrides, the command resolved at construction
+        # time is reused, PATH is not looked at again.
+        lookups = []
+        _executables.resolve = lambda *args: lookups.append(args)
+        try:
+            assert poorexec.call(stdout=None) == 1
+            assert lookups == []
+        finally:
+            del _executables.resolve
+    finally:
+        for bindir in bindirs:
+            shutil.rmtree(bindir)
+
+def check_close_fds():
+    import os
+
+    keep_r, keep_w = os.pipe()
+    leak_r, leak_w = os.pipe()
+    try:
+        script = 'for fd in {0} {1} {2} {3}; do [ -e /dev/fd/$fd ] && echo $fd; done; true'
+        r = subprocess.check_output(['sh', '-c',
+            script.format(keep_r, keep_w, leak_r, leak_w)],
+            pass_fds=[keep_w])
+        print r
+        assert r == '{0}\n'.format(keep_w)
+    finally:
+        for fd in (keep_r, keep_w, leak_r, leak_w):
+            os.close(fd)
+
+def test_close_fds():
+    check_close_fds()
+
+def test_close_fds_without_close_range():
+    from gevent_subprocess import gevent_subprocess as impl
+
+    syscall = impl._syscall
+    impl._syscall = None
+    try:
+        check_close_fds()
+    finally:
+        impl._syscall = syscall
+
+def test_spawn_in_thread():
+    import time
+    import gevent
+    from cStringIO import StringIO
+
+    ticks = []
+    def ticker():
+        while True:
+            ticks.append(time.time())
+            gevent.sleep(0.001)
+
+    # the child holds the parent in fork/exec for 0.2s, the hub must go on.
+    slow_exec = lambda: time.sleep(0.2)
+    hub = gevent.get_hub()
+    stream, hub.exception_stream = hub.exception_stream, StringIO()
+    t = gevent.spawn(ticker)
+    try:
+        gevent.sleep(0.01)
+        r = subprocess.check_output('ls -d /tmp'.split(' '),
+                spawn_in_thread=True)
+        assert r == '/tmp\n'
+        for x in xrange(5):
+            assert subprocess.call('true', preexec_fn=slow_exec,
+                    spawn_in_thread=True) == 0
+        for x in xrange(3):
+            with assert_raises(OSError):
+                subprocess.check_call('/donotexist/poorexec',
+                        spawn_in_thread=True)
+        t.kill()
+        errors = hub.exception_stream.getvalue()
+    finally:
+        hub.exception_stream = stream
+    gap = max(b - a for a, b in zip(ticks, ticks[1:]))
+    print 'ticks', len(ticks), 'largest gap', gap
+    assert gap < 0.1
+    assert errors == ''
@@ -398,3 +398,309 @@ def test_talking_with_sh():
     lines_to_write.put(StopIteration)
     writer.join()
     print 'All done cleanly'
+
+def test_iter_records_ndjson():
+    pr, pw = pipe()
+
+    def writer():
+        print 'writing records...'
+        for x in xrange(10000):
+            pw.write('{"id": %d, "name": "record"}\n' % x)
+            if x % 1000 == 0:
+                pw.write('\n')
+        print 'plus an unfinished one...'
+        pw.write('{"id": "last"}')
+        pw.close()
+        print 'writer bye bye'
+
+    def reader():
+        records = []
+        for batch in pr.iter_records('ndjson', batch=100):
+            assert 0 < len(batch) <= 100
+            records.extend(batch)
+        assert len(records) == 10001
+        assert [r['id'] for r in records[:-1]] == range(10000)
+        assert records[-1] == {'id': 'last'}
+        print 'reader bye bye'
+
+    p = Pool()
+    p.spawn(reader)
+    p.spawn(writer)
+    p.join(raise_error=True)
+
+def test_iter_records_ndjson_invalid():
+    pr, pw = pipe()
+
+    pw.write('{"id": 1}\n{"id": 2}, 3\n')
+    pw.close()
+    with assert_raises(ValueError):
+        list(pr.iter_records('ndjson'))
+
+def test_iter_records_ndjson_split_document():
+    # documents spanning lines, or several per line, are not ndjson.
+    for data in ['[1\n2]\n3,4\n', '"a\nb"\n1,2\n', '1 2\n']:
+        pr, pw = pipe()
+        pw.write(data)
+        pw.close()
+        with assert_raises(ValueError):
+            list(pr.iter_records('ndjson'))
+        pr.close()
+
+def test_iter_records_struct():
+    pr, pw = pipe()
+    import struct
+
+    def writer():
+        print 'writing records...'
+        for x in xrange(10000):
+            pw.write(struct.pack('<Id', x, x / 2.0))
+        print 'plus an incomplete one...'
+        pw.write('abc')
+        pw.close()
+        print 'writer bye bye'
+
+    def reader():
+        records = []
+        for batch in pr.iter_records('<Id'):
+            records.extend(batch)
+        assert records == [(x, x / 2.0) for x in xrange(10000)]
+        assert pr.read() == 'abc'
+        print 'reader bye bye'
+
+    p = Pool()
+    p.spawn(reader)
+    p.spawn(writer)
+    p.join(raise_error=True)
+
+def test_tee():
+    pr, pw = pipe()
+    log, lossy, slow = pr.tee(3, maxsize=4, policy=['block', 'drop', 'spill'])
+
+    chunk = 'x' * 1024
+    def writer():
+        print 'writing...'
+        for x in xrange(1000):
+            pw.write(chunk)
+            gevent.sleep(0)
+        print 'writer close'
+        pw.close()
+
+    def log_reader():
+        data = log.read()
+        assert data == chunk * 1000
+        print 'log reader bye bye'
+
+    def slow_reader():
+        gevent.sleep(0.2)
+        data = ''.join(slow)
+        assert data == chunk * 1000
+        assert slow.spilled > 0
+        print 'slow reader bye bye'
+
+    p = Pool()
+    p.spawn(log_reader)
+    p.spawn(slow_reader)
+    p.spawn(writer)
+    p.join(raise_error=True)
+
+    data = lossy.read()
+    print 'lossy got', len(data), 'dropped', lossy.dropped
+    assert lossy.dropped > 0
+    assert len(data) + lossy.dropped == len(chunk) * 1000
+    assert lossy.get() == ''
+
+def test_tee_errors():
+    import errno
+    pr, pw = pipe()
+    with assert_raises(ValueError):
+        pr.tee(3, policy=['block', 'drop'])
+
+    # a read error must not look like the end of the output.
+    recv = pr._recv
+    def failing_recv(size=64 * 1024):
+        data = recv(size)
+        if len(data) == 0:
+            raise OSError(errno.EIO, 'read error')
+        return data
+    pr._recv = failing_recv
+    first, second = pr.tee(2, policy=['block', 'spill'])
+    pw.write('hello')
+    pw.close()
+    for consumer in (first, second):
+        assert consumer.get() == 'hello'
+        with assert_raises(OSError):
+            consumer.get()
+
+def test_pty():
+
+    p = subprocess.Popen(['sh', '-c',
+        'test -t 1 && echo tty; read x; stty -F /dev/stdout size'],
+            stdin=subprocess.PIPE, stdout=subprocess.PTY)
+    line = p.stdout.readline()
+    print '>{0}<'.format(line)
+    assert line == 'tty\n'
+    p.stdout.set_winsize(42, 132)
+    p.stdin.write('go\n')
+    line = p.stdout.readline()
+    print '>{0}<'.format(line)
+    assert line == '42 132\n'
+    assert p.stdout.readline() == ''
+    assert p.wait() == 0
+
+def test_pty_stdin():
+
+    with assert_raises(ValueError):
+        subprocess.Popen(['cat'], stdin=subprocess.PTY)
+
+def test_pty_communicate():
+
+    p = subprocess.Popen(['sh', '-c', 'echo out; echo err >&2'],
+            stdout=subprocess.PTY, stderr=subprocess.STDOUT)
+    stdout, stderr = p.communicate(timeout=10)
+    assert stdout == 'out\nerr\n'
+    assert stderr is None
+
+def test_read_budget():
+    pr, pw = pipe()
+    pr.priority = 0.01
+    pw.write('x' * 60000)
+    pw.close()
+
+    ticks = [0]
+    def ticker():
+        while not pr.closed:
+            ticks[0] += 1
+            gevent.sleep(0)
+    t = gevent.spawn(ticker)
+    gevent.sleep(0)
+
+    data = ''
+    while not pr.closed:
+        data += pr.read(1000)
+    t.join()
+    print 'yields', pr.stats.yields, 'ticks', ticks[0], \
+        'max sched delay', pr.stats.max_sched_delay
+    assert data == 'x' * 60000
+    assert pr.stats.bytes == 60000
+    assert pr.stats.yields >= 20
+    assert ticks[0] >= 20
+
+def test_read_budget_slow_consumer():
+    import time
+    pr, pw = pipe()
+    pw.write('x' * 60000)
+    pw.close()
+
+    # the time spent between reads is not time spent reading.
+    data = ''
+    while not pr.closed:
+        data += pr.read(1000)
+        time.sleep(0.006)
+    print 'yields', pr.stats.yields
+    assert data == 'x' * 60000
+    assert pr.stats.yields == 0
+
+def test_popen_priority():
+
+    p = subprocess.Popen(['head', '-c', '1000000', '/dev/zero'],
+            stdout=subprocess.PIPE, priority=subprocess.PRIORITY_HIGH)
+    assert p.stdout.priority == subprocess.PRIORITY_HIGH
+    stdout, stderr = p.communicate()
+    assert len(stdout) == 1000000
+    assert p.stdout.stats.bytes == 1000000
+    assert p.stdout.stats.reads > 0
+
+def test_expect():
+    import re
+    pr, pw = pipe()
+
+    def writer():
+        print 'writing...'
+        for c in 'login: ':
+            pw.write(c)
+            gevent.sleep(0.001)
+        pw.write('x' * 100000)
+        pw.write('Password for user42: ')
+        gevent.sleep(0.5)
+        pw.write('$ ')
+        pw.close()
+        print 'writer bye bye'
+
+    def reader():
+        index, match, before = pr.expect(['login: ', 'ogin: '])
+        assert (index, match, before) == (0, 'login: ', '')
+        index, match, before = pr.expect(
+            ['$ ', re.compile(r'Password for (\w+): ')])
+        assert index == 1
+        assert match.group(1) == 'user42'
+        assert before == 'x' * 100000
+        with assert_raises(subprocess.TimeoutExpired):
+            pr.expect('$ ', timeout=0.05)
+        assert pr.expect('$ ', timeout=5) == (0, '$ ', '')
+        with assert_raises(EOFError):
+            pr.expect('never', timeout=5)
+        print 'reader bye bye'
+
+    p = Pool()
+    p.spawn(reader)
+    p.spawn(writer)
+    p.join(raise_error=True)
+
+def test_expect_anchored():
+    import re
+
+    def expect(patterns):
+        pr, pw = pipe()
+
+        def writer():
+            pw.write('a' * 5000 + 'XPROMPT> abcdefgh')
+            gevent.sleep(0.1)
+            pw.write('more\n')
+            pw.close()
+
+        g = gevent.spawn(writer)
+        result = pr.expect(patterns, window=16, timeout=5)
+        g.join()
+        return result
+
+    # the prompt is not at the start of the data, '^' must not match.
+    index, match, before = expect([re.compile('^PROMPT> '), 'more\n'])
+    assert index == 1
+    assert before == 'a' * 5000 + 'XPROMPT> abcdefgh'
+    index, match, before = expect([re.compile(r'\Amore'),
+                                   re.compile('(?<=h)more')])
+    assert index == 1
+    assert len(before) == 5000 + 17
+
+    pr, pw = pipe()
+    with assert_raises(subprocess.TimeoutExpired) as cm:
+        pr.expect('never', timeout=0.05)
+    assert str(cm.exception) == 'Timed out after 0.05 seconds'
+
+def test_expect_sh():
+
+    p = subprocess.Popen(['sh', '-i'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+            env={'PS1': 'PROMPT> ', 'PATH': '/bin:/usr/bin'})
+    p.stdout.expect('PROMPT> ', timeout=5)
+    p.stdin.write('echo $((6 * 7))\n')
+    index, match, before = p.stdout.expect('PROMPT> ', timeout=5)
+    assert before == '42\n'
+    p.stdin.write('exit\n')
+    assert p.wait(timeout=5) == 0
+
+def test_expect_large():
+    import time
+    size = 32 * 1024 * 1024
+    p = subprocess.Popen('head -c %d /dev/zero; printf "MARK rest"' % size,
+            shell=True, stdout=subprocess.PIPE)
+    start = time.time()
+    index, match, before = p.stdout.expect(['MARK', 'never'], timeout=30)
+    elapsed = time.time() - start
+    print 'expect over %d bytes took %.2fs' % (size, elapsed)
+    assert (index, match) == (0, 'MARK')
+    assert len(before) == size
+    assert before.count('\0') == size
+    assert p.stdout.read() == ' rest'
+    assert p.wait() == 0
+    assert elapsed < 3
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2012 François-Xavier Bourlet (bombela@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+# A soak test: mixed workloads, checked for leaks after each phase.
+#
+# It runs small by default, scale it up with the environment, e.g.:
+#
+#   ulimit -n 65536
+#   SOAK_CHILDREN=10000 SOAK_DURATION=60 nosetests -s test/test_soak.py
+#
+# SOAK_CHILDREN   concurrent children per phase (default 50)
+# SOAK_DURATION   seconds each phase keeps spawning (default 1)
+# SOAK_RSS_MB     allowed RSS growth over the whole run (default 32)
+
+import gc
+import os
+import time
+import greenlet
+import gevent
+from gevent.pool import Pool
+import gevent_subprocess as subprocess
+
+CHILDREN = int(os.environ.get('SOAK_CHILDREN', 50))
+DURATION = float(os.environ.get('SOAK_DURATION', 1))
+RSS_MB = float(os.environ.get('SOAK_RSS_MB', 32))
+
+
+def open_fds():
+    return len(os.listdir('/proc/self/fd'))
+
+def zombies():
+    count = 0
+    for pid in os.listdir('/proc'):
+        if not pid.isdigit():
+            continue
+        try:
+            with open('/proc/{0}/stat'.format(pid)) as f:
+                stat = f.read()
+        except IOError:
+            continue
+        # the command name is between parentheses and may hold spaces.
+        fields = stat[stat.rindex(')') + 2:].split()
+        if fields[0] == 'Z' and int(fields[1]) == os.getpid():
+            count += 1
+    return count
+
+def greenlets():
+    return sum(1 for o in gc.get_objects() if isinstance(o, greenlet.greenlet))
+
+def rss_mb():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024. * 1024.)
+
+
+def do_communicate():
+    p = subprocess.Popen(['sh', '-c',
+            'cat; head -c 100000 /dev/zero; echo err >&2'], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    stdout, stderr = p.communicate('hello\n')
+    assert len(stdout) == len('hello\n') + 100000
+    assert stderr == 'err\n'
+    assert p.returncode == 0
+
+def do_readline():
+    p = subprocess.Popen(['seq', '1', '1000'], stdout=subprocess.PIPE)
+    count = 0
+    for line in iter(p.stdout.readline, ''):
+        count += 1
+    assert count == 1000
+    assert p.wait() == 0
+
+def do_kill_mid_write():
+    p = subprocess.Popen(['cat'], stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+    def writer():
+        try:
+            while True:
+                p.stdin.write('x' * 64 * 1024)
+        except IOError:
+            pass
+    w = gevent.spawn(writer)
+    p.stdout.read(1024)
+    p.kill()
+    w.join()
+    p.stdout.read()
+    assert p.wait() == -9
+
+def do_epipe():
+    p = subprocess.Popen(['true'], stdin=subprocess.PIPE)
+    try:
+        while True:
+            p.stdin.write('x' * 64 * 1024)
+    except IOError:
+        pass
+    assert p.stdin.closed
+    assert p.wait() == 0
+
+
+def run_phase(name, workload):
+    print 'phase', name, '...'
+    pool = Pool(CHILDREN)
+    spawned = 0
+    end = time.time() + DURATION
+    while time.time() < end or spawned < CHILDREN:
+        pool.spawn(workload)
+        spawned += 1
+    pool.join(raise_error=True)
+    print 'phase', name, 'ran', spawned, 'children'
+
+def check(baseline):
+    gc.collect()
+    state = dict(fds=open_fds(), zombies=zombies(), greenlets=greenlets(),
+                 rss=rss_mb())
+    print 'fds {fds}, zombies {zombies}, greenlets {greenlets}, ' \
+        'rss {rss:.1f}MB'.format(**state)
+    assert state['fds'] <= baseline['fds']
+    assert state['zombies'] == 0
+    # the deadline wheel ticker, and the hub, may come and go.
+    assert state['greenlets'] <= baseline['greenlets'] + 2
+    assert state['rss'] - baseline['rss'] <= RSS_MB
+
+def test_soak():
+    # warm up, so that lazy allocations do not count as growth.
+    run_phase('warmup', do_communicate)
+    gc.collect()
+    baseline = dict(fds=open_fds(), greenlets=greenlets(), rss=rss_mb())
+
+    for name, workload in [('communicate', do_communicate),
+                           ('readline', do_readline),
+                           ('kill mid-write', do_kill_mid_write),
+                           ('EPIPE', do_epipe)]:
+        run_phase(name, workload)
+        check(baseline)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+# Open Source Initiative OSI - The MIT License (MIT):Licensing
+#
+# The MIT License (MIT)
+# Copyright (c) 2012 François-Xavier Bourlet (bombela@gmail.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of
+# this software and associated documentation files (the "Software"), to deal in
+# the Software without restriction, including without limitation the rights to
+# use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies
+# of the Software, and to permit persons to whom the Software is furnished to do
+# so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+
+import gevent_subprocess as subprocess
+from gevent.pool import Pool
+from nose.tools import assert_raises
+
+def test_supervisor():
+
+    with subprocess.Supervisor(2) as supervisor:
+        print 'spawn /bin/sh...'
+        p = supervisor.Popen(['/bin/sh'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        print 'pid', p.pid
+        assert p.pid > 0
+
+        print 'communicate...'
+        stdout, stderr = p.communicate('echo COUCOU\necho ERR >&2\nexit 3\n')
+        print 'stdout --\n', stdout
+        assert stdout == 'COUCOU\n'
+        assert stderr == 'ERR\n'
+        assert p.returncode == 3
+
+        with assert_raises(OSError):
+            supervisor.Popen('/donotexist/poorexec')
+        with assert_raises(ValueError):
+            supervisor.Popen(['ls'], stdout=open('/dev/null', 'w'))
+
+def test_supervisor_lots_of_children():
+
+    with subprocess.Supervisor(4) as supervisor:
+        def coro(x):
+            p = supervisor.Popen(['sh', '-c', 'echo $0', str(x)],
+                    stdout=subprocess.PIPE)
+            stdout, stderr = p.communicate()
+            assert stdout == '{0}\n'.format(x)
+            assert p.returncode == 0
+
+        p = Pool()
+        for x in xrange(200):
+            p.spawn(coro, x)
+        p.join(raise_error=True)
+
+def test_supervisor_timeout_and_kill():
+
+    with subprocess.Supervisor(1) as supervisor:
+        p = supervisor.Popen('sleep 500'.split(' '))
+        with assert_raises(subprocess.TimeoutExpired):
+            p.wait(timeout=0.2)
+        p.kill()
+        assert p.wait(timeout=5) == -9
+
+def test_supervisor_unpicklable_input():
+    import cPickle as pickle
+
+    with subprocess.Supervisor(1) as supervisor:
+        p = supervisor.Popen(['cat'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        with assert_raises(pickle.PicklingError):
+            p.stdin.write(lambda: 'hello')
+        print 'the shard still works...'
+        assert supervisor.Popen(['true']).wait(timeout=5) == 0
+        def chunks():
+            yield 'hel'
+            yield 'lo'
+        assert p.communicate(chunks(), timeout=5) == ('hello', None)
+
+def test_supervisor_streams():
+
+    with subprocess.Supervisor(1) as supervisor:
+        p = supervisor.Popen(['cat'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        for x in xrange(3):
+            p.stdin.write('line %d\n' % x)
+            assert p.stdout.readline() == 'line %d\n' % x
+        p.stdin.writelines(['a\n', 'b\n'])
+        p.stdin.close()
+        assert list(p.stdout) == ['a\n', 'b\n']
+        assert p.stdout.read() == ''
+        assert p.wait(timeout=5) == 0
+
+        # the supervisor drains the output even if nobody reads it.
+        p = supervisor.Popen(['head', '-c', '1000000', '/dev/zero'],
+                stdout=subprocess.PIPE)
+        assert p.wait(timeout=5) == 0
+        assert p.stdout.read(10) == '\0' * 10
+        assert len(p.stdout.read()) == 1000000 - 10
+
+def test_supervisor_input_after_communicate():
+
+    with subprocess.Supervisor(1) as supervisor:
+        p = supervisor.Popen(['cat'], stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE)
+        assert p.communicate(timeout=5) == ('', None)
+        with assert_raises(ValueError):
+            p.communicate('hello')
+
+def test_supervisor_local_arguments():
+
+    with subprocess.Supervisor(1) as supervisor:
+        for kwargs in ({'pass_fds': [0]}, {'spawn_in_thread': True},
+                       {'memfd_input': 'hello'}, {'preexec_fn': id}):
+            with assert_raises(ValueError):
+                supervisor.Popen(['true'], **kwargs)
+
+def test_supervisor_truncated_frame():
+    from gevent_subprocess import supervisor as impl
+
+    receive = impl._receive
+    def truncated(pipe):
+        message = receive(pipe)
+        if message is not None:
+            raise EOFError('truncated frame')
+        return message
+
+    with subprocess.Supervisor(1) as supervisor:
+        p = supervisor.Popen(['sh', '-c', 'sleep 0.2; echo hi'],
+                stdout=subprocess.PIPE)
+        impl._receive = truncated
+        try:
+            with assert_raises(IOError):
+                p.communicate(timeout=5)
+            assert p.wait(timeout=5) is None
+        finally:
+            impl._receive = receive
+
+def test_supervisor_poll():
+    import gevent
+
+    with subprocess.Supervisor(1) as supervisor:
+        p = supervisor.Popen(['true'])
+        for x in xrange(100):
+            if p.poll() is not None:
+                break
+            gevent.sleep(0.05)
+        assert p.poll() == 0
+        assert p.communicate() == (None, None)
@@ -22,7 +22,9 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import signal
 import gevent_subprocess as subprocess
+from gevent_subprocess.gevent_subprocess import _deadlines
 import gevent
 from gevent.pool import Pool
 
@@ -57,3 +59,92 @@ def test_lots_of_sleep():
         p.spawn(coro)
     print 'wait for completion...'
     p.join()
+
+def test_wait_timeout():
+    print 'spawn process...'
+    p = subprocess.Popen('sleep 500'.split(' '))
+
+    print 'wait with timeout...'
+    try:
+        p.wait(timeout=0.2)
+        assert False, 'TimeoutExpired not raised'
+    except subprocess.TimeoutExpired as e:
+        print e
+        assert e.timeout == 0.2
+    assert p.returncode is None
+
+    print 'escalate...'
+    r = p.escalate(((signal.SIGTERM, 1.0),))
+    print 'done with return code:', r
+    assert r == -15
+
+def test_lots_of_timeouts():
+
+    def coro():
+        p = subprocess.Popen('sleep 500'.split(' '), close_fds=True)
+        try:
+            p.wait(timeout=0.5)
+        except subprocess.TimeoutExpired:
+            pass
+        p.kill()
+        assert p.wait(timeout=5) == -9
+
+    p = Pool()
+    print 'spawn sleep processes...'
+    for x in xrange(200):
+        p.spawn(coro)
+    print 'wait for completion...'
+    p.join(raise_error=True)
+    assert _deadlines._pending == 0
+
+def test_process_table():
+    p = subprocess.Popen(['sh', '-c', 'echo hello; exec sleep 500'],
+            stdout=subprocess.PIPE)
+    assert p.stdout.readline() == 'hello\n'
+
+    table = [e for e in subprocess.process_table() if e['pid'] == p.pid]
+    print table
+    assert len(table) == 1
+    entry = table[0]
+    assert entry['args'] == ['sh', '-c', 'echo hello; exec sleep 500']
+    assert entry['state'] == 'running'
+    assert entry['age'] >= 0
+    assert entry['owner'] is not None
+    assert entry['stdin'] is None
+    assert entry['stdout'] == len('hello\n')
+
+    def waiter():
+        return p.wait()
+    w = gevent.spawn(waiter)
+    gevent.sleep(0.05)
+    table = [e for e in subprocess.process_table() if e['pid'] == p.pid]
+    assert table[0]['state'] == 'reaping'
+
+    p.kill()
+    assert w.get() == -9
+    assert p.pid not in [e['pid'] for e in subprocess.process_table()]
+
+def test_timeout_with_busy_hub():
+    import time
+
+    def busy():
+        while True:
+            end = time.time() + 0.03
+            while time.time() < end:
+                pass
+            gevent.sleep(0)
+    b = gevent.spawn(busy)
+
+    p = subprocess.Popen('sleep 500'.split(' '))
+    start = time.time()
+    try:
+        p.wait(timeout=1.0)
+        assert False, 'TimeoutExpired not raised'
+    except subprocess.TimeoutExpired:
+        pass
+    elapsed = time.time() - start
+    b.kill()
+    p.kill()
+    p.wait()
+    print 'elapsed', elapsed
+    assert 1.0 <= elapsed < 1.5